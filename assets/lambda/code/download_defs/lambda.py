@@ -3,19 +3,52 @@
 
 import boto3
 import botocore
+import contextlib
+import functools
 import json
 import logging
 import os
 import pwd
 import re
 import subprocess
+import tempfile
+import time
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from aws_lambda_powertools import Logger
 
 
 logger = Logger()
 
 
-s3_resource = boto3.resource("s3")
+# Clients are shared by warm invocations so connections are reused
+session = boto3.session.Session()
+S3_CONFIG = Config(
+    retries={"mode": "standard", "total_max_attempts": 5},
+    max_pool_connections=50,
+    connect_timeout=2,
+    read_timeout=30,
+    tcp_keepalive=True,
+)
+s3_client = session.client("s3", config=S3_CONFIG)
+
+# The execution user never changes within an execution context
+LAMBDA_USER = pwd.getpwuid(os.getuid()).pw_name
+
+MB = 1024 * 1024
+OUTPUT_MAX_BYTES = 64 * 1024
+# main.cvd is well over 100 MB, upload it in parallel parts
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * MB,
+    multipart_chunksize=64 * MB,
+    max_concurrency=10,
+    use_threads=True,
+)
+
+# ClamAV publishes new definitions a few times a day at most
+UPDATE_INTERVAL = 3600
+last_update_time = 0
 
 
 class ClamAVException(Exception):
@@ -31,71 +64,91 @@ class ClamAVException(Exception):
 @logger.inject_lambda_context(log_event=True)
 def lambda_handler(event, context):
     """Updates the cvd files in the S3 Bucket"""
-    print(json.dumps(event))
-    defs_bucket = s3_resource.Bucket(os.environ["DEFS_BUCKET"])
+    global last_update_time
+    if time.time() - last_update_time < UPDATE_INTERVAL:
+        logger.info("Definitions were updated within the last hour")
+        return
+    defs_bucket = os.environ["DEFS_BUCKET"]
     download_path = "/tmp"
     download_s3_defs(download_path, defs_bucket)
     freshclam_update(download_path)
     upload_s3_defs(download_path, defs_bucket)
+    last_update_time = time.time()
 
 
 def download_s3_defs(download_path, defs_bucket):
     """download CVD and conf files from definitions bucket (if they exist)
     to compare against ClamAV database. Respect their hosting costs!"""
+    # Downloading ClamAV definitions and exceeds Lambda's tmp directory max size
+    # https://github.com/awslabs/cdk-serverless-clamscan/issues/118
+    # file_regex = [r"\w+.c[vl]d", r"freshclam.conf"]
+    file_regex = [r"freshclam.conf"]
+    file_pattern = r"||".join(file_regex)
     try:
-        # Downloading ClamAV definitions and exceeds Lambda's tmp directory max size
-        # https://github.com/awslabs/cdk-serverless-clamscan/issues/118
-        # file_regex = [r"\w+.c[vl]d", r"freshclam.conf"]
-        file_regex = [r"freshclam.conf"]
-        file_pattern = r"||".join(file_regex)
-        for file in defs_bucket.objects.all():
-            filename = file.key
-            if re.match(file_pattern, filename):
-                defs_bucket.download_file(
-                    filename, f"{download_path}/{filename}"
-                )
+        paginator = s3_client.get_paginator("list_objects_v2")
+        filenames = [
+            file["Key"]
+            for page in paginator.paginate(Bucket=defs_bucket)
+            for file in page.get("Contents", [])
+            if re.match(file_pattern, file["Key"])
+        ]
     except botocore.exceptions.ClientError:
-        pass
+        return
+    # The downloads are independent, fetch them concurrently
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(
+                s3_client.download_file,
+                defs_bucket,
+                filename,
+                f"{download_path}/{filename}",
+            )
+            for filename in filenames
+        ]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except botocore.exceptions.ClientError:
+                pass
 
 
 def upload_s3_defs(download_path, defs_bucket):
     """Upload CVD and DB files to definitions bucket"""
-    try:
-        for root, _, files in os.walk(download_path):
-            for file in files:
-                defs_bucket.upload_file(os.path.join(root, file), file)
-    except botocore.exceptions.ClientError as e:
-        msg = e.response["Error"]["Message"]
-        logger.error(msg)
-        report_failure(msg)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(
+                s3_client.upload_file,
+                os.path.join(root, file),
+                defs_bucket,
+                file,
+                Config=TRANSFER_CONFIG,
+            )
+            for root, _, files in os.walk(download_path)
+            for file in files
+        ]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except botocore.exceptions.ClientError as e:
+                msg = e.response["Error"]["Message"]
+                logger.error(msg)
+                report_failure(msg)
 
 
 def freshclam_update(download_path):
     """Points freshclam to the local database files. Downloads
     the latest database files"""
-    conf = "/tmp/freshclam.conf"
-    # will already exist when Lambdas are running in same execution context
-    # or downloaded from the Virus Defs bucket
-    if not os.path.exists(conf):
-        with open(conf, "a") as f:
-            f.write("\nDNSDatabaseInfo current.cvd.clamav.net")
-            f.write("\nDatabaseMirror  database.clamav.net")
-            f.write("\nReceiveTimeout  0")
-            f.write("\nCompressLocalDatabase  true")
+    conf = freshclam_conf()
     try:
         command = [
             "freshclam",
             f"--config-file={conf}",
             "--stdout",
             "-u",
-            f"{pwd.getpwuid(os.getuid()).pw_name}",
+            LAMBDA_USER,
             f"--datadir={download_path}",
         ]
-        update_summary = subprocess.run(
-            command,
-            stderr=subprocess.STDOUT,
-            stdout=subprocess.PIPE,
-        )
+        update_summary = run_command(command)
         if update_summary.returncode != 0:
             raise ClamAVException(
                 f"FreshClam exited with unexpected code: {update_summary.returncode}"
@@ -108,6 +161,32 @@ def freshclam_update(download_path):
     return
 
 
+@functools.lru_cache(maxsize=1)
+def freshclam_conf():
+    """Writes the freshclam config once per execution context"""
+    conf = "/tmp/freshclam.conf"
+    # may already be downloaded from the Virus Defs bucket
+    with contextlib.suppress(FileExistsError), open(conf, "x") as f:
+        f.write("\nDNSDatabaseInfo current.cvd.clamav.net")
+        f.write("\nDatabaseMirror  database.clamav.net")
+        f.write("\nReceiveTimeout  0")
+        f.write("\nCompressLocalDatabase  true")
+    return conf
+
+
+def run_command(command):
+    """Runs the command with its combined output going to a temporary file,
+    so verbose runs are not buffered in memory, and returns only the tail
+    of the output"""
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.run(
+            command, stderr=subprocess.STDOUT, stdout=output
+        )
+        output.seek(max(0, output.seek(0, os.SEEK_END) - OUTPUT_MAX_BYTES))
+        process.stdout = output.read()
+    return process
+
+
 def report_failure(message):
     """Raise an error formatted for the POWERTOOLS namespace"""
     exception_json = {
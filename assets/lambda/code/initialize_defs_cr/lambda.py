@@ -7,16 +7,35 @@ import botocore
 import urllib3
 import json
 import time
+from botocore.config import Config
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-http = urllib3.PoolManager()
+http = urllib3.PoolManager(
+    num_pools=2,
+    maxsize=4,
+    retries=urllib3.Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+    ),
+    timeout=urllib3.Timeout(connect=2.0, read=10.0),
+)
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
-sfn_client = boto3.client("stepfunctions")
-lambda_client = boto3.client("lambda")
+session = boto3.session.Session()
+# The definitions download runs for up to five minutes. A retry would
+# start another download, so the invoke is attempted only once
+lambda_client = session.client(
+    "lambda",
+    config=Config(
+        retries={"mode": "standard", "total_max_attempts": 1},
+        connect_timeout=2,
+        read_timeout=310,
+    ),
+)
 
 
 def lambda_handler(event, context):
@@ -35,9 +54,12 @@ def lambda_handler(event, context):
                 reason = f"Initial definition download failed: {error}"
                 logger.error(reason)
                 return send(event, context, FAILED, {}, reason=reason)
-        except botocore.exceptions.ClientError as e:
+        except (
+            botocore.exceptions.ClientError,
+            botocore.exceptions.BotoCoreError,
+        ) as e:
             logger.error(e)
-            return send(event, context, FAILED, {}, reason=e)
+            return send(event, context, FAILED, {}, reason=str(e))
     else:
         reason = f"Nothing to do on {event_type}"
         logger.info(reason)
@@ -4,21 +4,40 @@
 from posixpath import join
 import boto3
 import botocore
-import glob
+import collections
+import contextlib
+import functools
+import itertools
 import json
 import logging
 import os
 import pwd
+import socket
+import struct
 import subprocess
+import tempfile
 import shutil
+import time
+import uuid
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote_plus
 from aws_lambda_powertools import Logger, Metrics
 
 logger = Logger()
 metrics = Metrics()
 
-s3_resource = boto3.resource("s3")
-s3_client = boto3.client("s3")
+# Clients are shared by warm invocations so connections are reused
+session = boto3.session.Session()
+S3_CONFIG = Config(
+    retries={"mode": "standard", "total_max_attempts": 5},
+    max_pool_connections=50,
+    connect_timeout=2,
+    read_timeout=30,
+    tcp_keepalive=True,
+)
+s3_client = session.client("s3", config=S3_CONFIG)
 
 INPROGRESS = "IN PROGRESS"
 CLEAN = "CLEAN"
@@ -26,8 +45,62 @@ INFECTED = "INFECTED"
 ERROR = "ERROR"
 SKIP = "N/A"
 
+# The execution user never changes within an execution context
+LAMBDA_USER = pwd.getpwuid(os.getuid()).pw_name
+
 MAX_BYTES = 4000000000
 
+LOCAL_PAYLOAD_ROOT = "/tmp"
+
+CLAMD_CONF = "/tmp/clamd.conf"
+CLAMD_SOCKET = "/tmp/clamd.sock"
+# Belongs to this execution context's clamd, which writes decompressed
+# archive members and streamed objects here. The construct sizes /tmp for it
+CLAMD_TMP_PATH = "/tmp/clamd-tmp"
+CLAMD_STARTUP_TIMEOUT = 300
+# Seconds kept from the Lambda timeout to report a stream scan that hangs
+CLAMD_TIMEOUT_MARGIN = 10
+# Only these files hold signatures, freshclam's work files come and go
+DEFINITION_SUFFIXES = (".cvd", ".cld", ".cud")
+
+MB = 1024 * 1024
+OUTPUT_MAX_BYTES = 64 * 1024
+# Large objects are fetched as parallel 16 MB byte-range GETs
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * MB,
+    multipart_chunksize=16 * MB,
+    max_concurrency=max(10, (os.cpu_count() or 1) * 4),
+    io_chunksize=MB,
+    max_io_queue=1000,
+    use_threads=True,
+)
+# Objects fetched with a single GET are streamed straight to clamd
+STREAM_MAX_BYTES = TRANSFER_CONFIG.multipart_threshold
+# 7za can only extract these formats without seeking in the archive
+STREAMABLE_ARCHIVES = (".tar",)
+# Times a streamed object is resumed after its connection drops
+STREAM_RESUME_ATTEMPTS = 5
+
+# Results of recent scans, for duplicate deliveries of the same S3 event
+RESULT_CACHE_SIZE = 4096
+scan_results = collections.OrderedDict()
+
+# Tags of the objects tagged by the current invocation
+object_tags = {}
+# Versions of the objects the current invocation was triggered for
+object_versions = {}
+
+# Directories already created in this execution context
+created_dirs = set()
+
+# freshclam run started during init, waited on by the first invocation
+freshclam_prewarm = None
+
+# clamd keeps the signatures in memory between warm invocations
+clamd_process = None
+# Fingerprint of the definition files clamd last loaded
+clamd_definitions = None
+
 
 class ClamAVException(Exception):
     """Raise when ClamAV returns an unexpected exit code"""
@@ -59,39 +132,57 @@ class FileTooBigException(Exception):
         return str(self.message)
 
 
+class ResumableBody:
+    """Reads the body of an S3 GetObject response, resuming from the bytes
+    read so far with a ranged GET when the connection drops"""
+
+    def __init__(self, input_bucket, input_key, response):
+        self.input_bucket = input_bucket
+        self.input_key = input_key
+        self.etag = response["ETag"]
+        self.body = response["Body"]
+        self.offset = 0
+        self.resumes = 0
+
+    def read(self, size=-1):
+        while True:
+            try:
+                data = self.body.read(size)
+                self.offset += len(data)
+                return data
+            except (botocore.exceptions.BotoCoreError, OSError):
+                if self.resumes >= STREAM_RESUME_ATTEMPTS:
+                    raise
+                self.resumes += 1
+                self.body.close()
+                # IfMatch fails the read rather than mixing two objects
+                self.body = s3_client.get_object(
+                    Bucket=self.input_bucket,
+                    Key=self.input_key,
+                    Range=f"bytes={self.offset}-",
+                    IfMatch=self.etag,
+                    **version_args(self.input_bucket, self.input_key),
+                )["Body"]
+
+    def close(self):
+        self.body.close()
+
+
 @metrics.log_metrics(capture_cold_start_metric=True)
 @logger.inject_lambda_context(log_event=True)
 def lambda_handler(event, context):
-    logger.info(json.dumps(event))
+    object_tags.clear()
+    object_versions.clear()
     bucket_info = event["Records"][0]["s3"]
     input_bucket = bucket_info["bucket"]["name"]
     input_key = unquote_plus(bucket_info["object"]["key"])
+    # Scan and tag the version the event is for, even if it is overwritten
+    version_id = bucket_info["object"].get("versionId")
+    if version_id:
+        object_versions[(input_bucket, input_key)] = version_id
     summary = ""
-    if not input_key.endswith("/"):
-        mount_path = os.environ["EFS_MOUNT_PATH"]
-        definitions_path = f"{mount_path}/{os.environ['EFS_DEF_PATH']}"
-        payload_path = f"{mount_path}/{context.aws_request_id}"
-        tmp_path = f"{payload_path}-tmp"
-        set_status(input_bucket, input_key, INPROGRESS)
-        create_dir(input_bucket, input_key, payload_path)
-        create_dir(input_bucket, input_key, tmp_path)
-        download_object(input_bucket, input_key, payload_path)
-        expand_if_large_archive(
-            input_bucket,
-            input_key,
-            payload_path,
-            bucket_info["object"]["size"],
-        )
-        create_dir(input_bucket, input_key, definitions_path)
-        freshclam_update(
-            input_bucket, input_key, payload_path, definitions_path
-        )
-        summary = scan(
-            input_bucket, input_key, payload_path, definitions_path, tmp_path
-        )
-        delete(payload_path)
-        delete(tmp_path)
-    else:
+    cache_key = result_cache_key(bucket_info)
+    if input_key.endswith("/"):
         summary = {
             "source": "serverless-clamscan",
             "input_bucket": input_bucket,
@@ -99,32 +190,117 @@ def lambda_handler(event, context):
             "status": SKIP,
             "message": "S3 Event trigger was for a non-file object",
         }
+    elif cache_key in scan_results:
+        summary = scan_results[cache_key]
+        scan_results.move_to_end(cache_key)
+        set_status(input_bucket, input_key, summary["status"])
+    else:
+        mount_path = os.environ["EFS_MOUNT_PATH"]
+        definitions_path = f"{mount_path}/{os.environ['EFS_DEF_PATH']}"
+        byte_size = bucket_info["object"]["size"]
+        delete_stale_payloads()
+        payload_root = mount_path
+        # Archives 7za expands stay on EFS, and clamd keeps room in /tmp to
+        # write the largest member it scans
+        if (
+            byte_size <= MAX_BYTES
+            and byte_size + MAX_BYTES
+            < shutil.disk_usage(LOCAL_PAYLOAD_ROOT).free
+        ):
+            payload_root = LOCAL_PAYLOAD_ROOT
+        payload_path = f"{payload_root}/{context.aws_request_id}"
+        set_status(input_bucket, input_key, INPROGRESS)
+        stream = byte_size <= STREAM_MAX_BYTES
+        create_dir(input_bucket, input_key, definitions_path)
+        # freshclam and the payload download do not depend on each other
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            update = executor.submit(freshclam_update, definitions_path)
+            if not stream:
+                create_dir(input_bucket, input_key, payload_path)
+                body = None
+                if byte_size > MAX_BYTES and input_key.lower().endswith(
+                    STREAMABLE_ARCHIVES
+                ):
+                    body = open_object(input_bucket, input_key, payload_path)
+                else:
+                    download_object(input_bucket, input_key, payload_path)
+                expand_if_large_archive(
+                    input_bucket, input_key, payload_path, byte_size, body
+                )
+        check_freshclam_update(input_bucket, input_key, payload_path, update)
+        load_clamd(input_bucket, input_key, payload_path, definitions_path)
+        if stream:
+            timeout = max(
+                1,
+                context.get_remaining_time_in_millis() / 1000
+                - CLAMD_TIMEOUT_MARGIN,
+            )
+            summary = scan(
+                input_bucket,
+                input_key,
+                payload_path,
+                open_object(input_bucket, input_key, payload_path),
+                timeout,
+            )
+        else:
+            summary = scan(input_bucket, input_key, payload_path)
+            delete(payload_path)
+        if cache_key is not None:
+            scan_results[cache_key] = summary
+            if len(scan_results) > RESULT_CACHE_SIZE:
+                scan_results.popitem(last=False)
     logger.info(summary)
     return summary
 
 
+def result_cache_key(bucket_info):
+    """Identifies the object version an S3 event is for, so a duplicate
+    delivery of the event can reuse the earlier scan result"""
+    s3_object = bucket_info["object"]
+    version = s3_object.get("versionId") or s3_object.get("sequencer")
+    if version is None:
+        return None
+    return (bucket_info["bucket"]["name"], s3_object["key"], version)
+
+
 def set_status(bucket, key, status):
-    """Set the scan-status tag of the S3 Object"""
-    old_tags = {}
-    try:
-        response = s3_client.get_object_tagging(Bucket=bucket, Key=key)
-        old_tags = {i["Key"]: i["Value"] for i in response["TagSet"]}
-    except botocore.exceptions.ClientError as e:
-        logger.debug(e.response["Error"]["Message"])
+    """Set the scan-status tag of the S3 Object. Existing tags are only read
+    the first time the object's status is set in an invocation"""
+    old_tags = object_tags.get((bucket, key))
+    if old_tags is None:
+        old_tags = {}
+        try:
+            response = s3_client.get_object_tagging(
+                Bucket=bucket, Key=key, **version_args(bucket, key)
+            )
+            old_tags = {i["Key"]: i["Value"] for i in response["TagSet"]}
+        except botocore.exceptions.ClientError as e:
+            logger.debug(e.response["Error"]["Message"])
     new_tags = {"scan-status": status}
     tags = {**old_tags, **new_tags}
     s3_client.put_object_tagging(
         Bucket=bucket,
         Key=key,
+        **version_args(bucket, key),
         Tagging={
             "TagSet": [
                 {"Key": str(k), "Value": str(v)} for k, v in tags.items()
             ]
         },
     )
+    object_tags[(bucket, key)] = tags
     metrics.add_metric(name=status, unit="Count", value=1)
 
 
+def version_args(bucket, key):
+    """Request parameters pinning an S3 call to the version of the object
+    the invocation was triggered for, if the bucket is versioned"""
+    version_id = object_versions.get((bucket, key))
+    if version_id is None:
+        return {}
+    return {"VersionId": version_id}
+
+
 def create_dir(input_bucket, input_key, download_path):
     """Creates a directory at the specified location
     if it does not already exists"""
@@ -132,19 +308,43 @@ def create_dir(input_bucket, input_key, download_path):
     full_path = download_path
     if len(sub_dir) > 0:
         full_path = os.path.join(full_path, sub_dir)
-    if not os.path.exists(full_path):
-        try:
-            os.makedirs(full_path, exist_ok=True)
-        except OSError as e:
-            report_failure(input_bucket, input_key, download_path, str(e))
+    if full_path in created_dirs:
+        return
+    try:
+        os.makedirs(full_path, exist_ok=True)
+        created_dirs.add(full_path)
+    except OSError as e:
+        report_failure(input_bucket, input_key, download_path, str(e))
 
 
 def download_object(input_bucket, input_key, download_path):
-    """Downloads the specified file from S3 to EFS"""
+    """Downloads the specified file from S3 to the payload directory"""
+    try:
+        s3_client.download_file(
+            input_bucket,
+            input_key,
+            f"{download_path}/{input_key}",
+            ExtraArgs=version_args(input_bucket, input_key),
+            Config=TRANSFER_CONFIG,
+        )
+    except botocore.exceptions.ClientError as e:
+        report_failure(
+            input_bucket,
+            input_key,
+            download_path,
+            e.response["Error"]["Message"],
+        )
+
+
+def open_object(input_bucket, input_key, download_path):
+    """Opens the specified file from S3 for streaming"""
     try:
-        s3_resource.Bucket(input_bucket).download_file(
-            input_key, f"{download_path}/{input_key}"
+        response = s3_client.get_object(
+            Bucket=input_bucket,
+            Key=input_key,
+            **version_args(input_bucket, input_key),
         )
+        return ResumableBody(input_bucket, input_key, response)
     except botocore.exceptions.ClientError as e:
         report_failure(
             input_bucket,
@@ -154,28 +354,37 @@ def download_object(input_bucket, input_key, download_path):
         )
 
 
-def expand_if_large_archive(input_bucket, input_key, download_path, byte_size):
-    """Expand the file if it is an archival type and larger than ClamAV Max Size"""
+def expand_if_large_archive(
+    input_bucket, input_key, download_path, byte_size, body=None
+):
+    """Expand the file if it is an archival type and larger than ClamAV Max Size.
+    Archives in a streamable format are extracted straight from the response
+    body when one is given, without being downloaded first"""
     if byte_size > MAX_BYTES:
         file_name = f"{download_path}/{input_key}"
         try:
-            command = ["7za", "x", "-y", f"{file_name}", f"-o{download_path}"]
-            archive_summary = subprocess.run(
-                command,
-                stderr=subprocess.STDOUT,
-                stdout=subprocess.PIPE,
-            )
+            if body is None:
+                command = ["7za", "x", "-y", file_name, f"-o{download_path}"]
+            else:
+                command = [
+                    "7za",
+                    "x",
+                    "-y",
+                    "-si",
+                    "-ttar",
+                    f"-o{download_path}",
+                ]
+            archive_summary = run_command(command, body)
             if archive_summary.returncode not in [0, 1]:
                 raise ArchiveException(
                     f"7za exited with unexpected code: {archive_summary.returncode}."
                 )
-            delete(download_path, input_key)
-            large_file_list = []
-            for root, dirs, files in os.walk(download_path, topdown=False):
-                for name in files:
-                    size = os.path.getsize(os.path.join(root, name))
-                    if size > MAX_BYTES:
-                        large_file_list.append(name)
+            if body is None:
+                delete(download_path, input_key)
+            # One oversized file fails the scan, no need to walk the rest
+            large_file_list = list(
+                itertools.islice(iter_large_files(download_path), 1)
+            )
             if large_file_list:
                 raise FileTooBigException(
                     f"Archive {input_key} contains files {large_file_list} "
@@ -189,64 +398,202 @@ def expand_if_large_archive(input_bucket, input_key, download_path, byte_size):
             report_failure(input_bucket, input_key, download_path, e.message)
         except FileTooBigException as e:
             report_failure(input_bucket, input_key, download_path, e.message)
+        except botocore.exceptions.ClientError as e:
+            report_failure(
+                input_bucket,
+                input_key,
+                download_path,
+                e.response["Error"]["Message"],
+            )
+        except (botocore.exceptions.BotoCoreError, OSError) as e:
+            report_failure(input_bucket, input_key, download_path, str(e))
+        finally:
+            if body is not None:
+                body.close()
     else:
         return
 
 
-def freshclam_update(input_bucket, input_key, download_path, definitions_path):
-    """Points freshclam to the local database files and the S3 Definitions bucket.
-    Creates the database path on EFS if it does not already exist"""
-    conf = "/tmp/freshclam.conf"
-    # will already exist when Lambdas are running in same execution context
-    if not os.path.exists(conf):
-        with open(conf, "a") as f:
-            f.write(f"\nPrivateMirror {os.environ['DEFS_URL']}")
+def iter_large_files(path):
+    """Yields the names of files under path larger than ClamAV Max Size.
+    Uses the scandir entries' cached metadata to avoid a stat per file"""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_large_files(entry.path)
+            elif entry.stat(follow_symlinks=False).st_size > MAX_BYTES:
+                yield entry.name
+
+
+def freshclam_update(definitions_path):
+    """Points freshclam to the local database files and the S3 Definitions
+    bucket. Runs next to the payload download, so it only returns the
+    result and leaves reporting failures to check_freshclam_update"""
+    global freshclam_prewarm
+    # An update started during init already covers the first invocation
+    if freshclam_prewarm is not None:
+        prewarm, freshclam_prewarm = freshclam_prewarm, None
+        if prewarm.wait() == 0:
+            return subprocess.CompletedProcess(prewarm.args, 0, stdout=b"")
+    return run_command(freshclam_command(definitions_path))
+
+
+def check_freshclam_update(input_bucket, input_key, download_path, update):
+    """Reports a failure if the definitions update did not succeed. Called
+    once the payload download has stopped using download_path"""
     try:
-        command = [
-            "freshclam",
-            f"--config-file={conf}",
-            "--stdout",
-            "-u",
-            f"{pwd.getpwuid(os.getuid()).pw_name}",
-            f"--datadir={definitions_path}",
-        ]
-        update_summary = subprocess.run(
-            command,
-            stderr=subprocess.STDOUT,
-            stdout=subprocess.PIPE,
-        )
+        update_summary = update.result()
         if update_summary.returncode != 0:
             raise ClamAVException(
                 f"FreshClam exited with unexpected code: {update_summary.returncode}"
-                f"\nOutput: {update_summary.stdout.decode('utf-8')}"
+                f"\nOutput: {update_summary.stdout.decode('utf-8', 'replace')}"
             )
-    except subprocess.CalledProcessError as e:
-        report_failure(input_bucket, input_key, download_path, str(e.stderr))
+    except OSError as e:
+        report_failure(input_bucket, input_key, download_path, str(e))
     except ClamAVException as e:
         report_failure(input_bucket, input_key, download_path, e.message)
-    return
 
 
-def scan(input_bucket, input_key, download_path, definitions_path, tmp_path):
-    """Scans the object from S3"""
-    # Max file size support by ClamAV
+def freshclam_command(definitions_path):
+    """Builds the freshclam command"""
+    return [
+        "freshclam",
+        f"--config-file={freshclam_conf()}",
+        "--stdout",
+        "-u",
+        LAMBDA_USER,
+        f"--datadir={definitions_path}",
+    ]
+
+
+@functools.lru_cache(maxsize=1)
+def freshclam_conf():
+    """Writes the freshclam config once per execution context"""
+    conf = "/tmp/freshclam.conf"
+    # will already exist when /tmp outlives an execution context
+    with contextlib.suppress(FileExistsError), open(conf, "x") as f:
+        f.write(f"\nPrivateMirror {os.environ['DEFS_URL']}")
+    return conf
+
+
+def prewarm_freshclam():
+    """Starts a definitions update during the Lambda init phase so the first
+    invocation does not have to wait for all of it"""
+    mount_path = os.environ["EFS_MOUNT_PATH"]
+    definitions_path = f"{mount_path}/{os.environ['EFS_DEF_PATH']}"
     try:
-        command = [
-            "clamscan",
-            "-v",
-            "--stdout",
-            f"--max-filesize={MAX_BYTES}",
-            f"--max-scansize={MAX_BYTES}",
-            f"--database={definitions_path}",
-            "-r",
-            f"--tempdir={tmp_path}",
-            f"{download_path}",
-        ]
-        scan_summary = subprocess.run(
-            command,
-            stderr=subprocess.STDOUT,
-            stdout=subprocess.PIPE,
+        os.makedirs(definitions_path, exist_ok=True)
+        return subprocess.Popen(freshclam_command(definitions_path))
+    except OSError as e:
+        logger.warning(f"Could not start freshclam during init: {e}")
+        return None
+
+
+def load_clamd(input_bucket, input_key, download_path, definitions_path):
+    """Starts clamd with the definitions on EFS, or reloads its signatures
+    when freshclam changed them since clamd last loaded them"""
+    global clamd_process, clamd_definitions
+    try:
+        definitions = definitions_fingerprint(definitions_path)
+        if clamd_process is not None and clamd_process.poll() is None:
+            if definitions == clamd_definitions:
+                return
+            try:
+                clamd_command(b"RELOAD")
+                clamd_definitions = definitions
+                return
+            except OSError as e:
+                logger.warning(f"Restarting unresponsive clamd: {e}")
+                clamd_process.kill()
+                clamd_process.wait()
+        # Left over by a clamd killed along with an earlier execution context
+        if os.path.isdir(CLAMD_TMP_PATH):
+            delete_tree(CLAMD_TMP_PATH)
+        os.makedirs(CLAMD_TMP_PATH, exist_ok=True)
+        with open("/etc/clamd.conf") as f:
+            base_conf = f.read()
+        with open(CLAMD_CONF, "w") as f:
+            f.write(base_conf)
+            f.write(f"\nLocalSocket {CLAMD_SOCKET}")
+            f.write(f"\nDatabaseDirectory {definitions_path}")
+            f.write(f"\nTemporaryDirectory {CLAMD_TMP_PATH}")
+            f.write(f"\nMaxThreads {os.cpu_count() or 1}")
+            f.write(f"\nMaxFileSize {MAX_BYTES}")
+            f.write(f"\nMaxScanSize {MAX_BYTES}")
+            f.write(f"\nStreamMaxLength {MAX_BYTES}\n")
+        # EPEL installs clamd to /usr/sbin, which is not on the Lambda PATH
+        clamd_process = subprocess.Popen(
+            ["/usr/sbin/clamd", f"--config-file={CLAMD_CONF}"]
         )
+        deadline = time.monotonic() + CLAMD_STARTUP_TIMEOUT
+        while not ping_clamd():
+            if clamd_process.poll() is not None:
+                raise ClamAVException(
+                    f"clamd exited with unexpected code: {clamd_process.returncode}"
+                )
+            if time.monotonic() > deadline:
+                clamd_process.kill()
+                raise ClamAVException(
+                    f"clamd did not start within {CLAMD_STARTUP_TIMEOUT} seconds"
+                )
+            time.sleep(0.5)
+        clamd_definitions = definitions
+    except OSError as e:
+        report_failure(input_bucket, input_key, download_path, str(e))
+    except ClamAVException as e:
+        report_failure(input_bucket, input_key, download_path, e.message)
+
+
+def definitions_fingerprint(definitions_path):
+    """Summarizes the definition files by name, size and modification time
+    so updates made by freshclam can be detected without reading them"""
+    fingerprint = set()
+    with os.scandir(definitions_path) as entries:
+        for entry in entries:
+            if not entry.name.endswith(DEFINITION_SUFFIXES):
+                continue
+            # Other contexts' freshclam may replace files while listing
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            fingerprint.add((entry.name, stat.st_size, stat.st_mtime_ns))
+    return fingerprint
+
+
+def clamd_command(command):
+    """Sends a command to clamd over its local socket and returns the reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(CLAMD_SOCKET)
+        sock.sendall(b"z" + command + b"\0")
+        return sock.recv(1024).rstrip(b"\0")
+
+
+def ping_clamd():
+    """Checks if clamd is accepting commands"""
+    try:
+        return clamd_command(b"PING") == b"PONG"
+    except OSError:
+        return False
+
+
+def scan(input_bucket, input_key, download_path, body=None, timeout=None):
+    """Scans the object from S3, either downloaded to download_path or
+    streamed to clamd from the response body within timeout seconds"""
+    try:
+        if body is None:
+            command = [
+                "clamdscan",
+                "--infected",
+                "--stdout",
+                f"--config-file={CLAMD_CONF}",
+                "--multiscan",
+                f"{download_path}",
+            ]
+            scan_summary = run_command(command)
+        else:
+            scan_summary = clamd_instream(body, timeout)
         status = ""
         if scan_summary.returncode == 0:
             status = CLEAN
@@ -255,7 +602,7 @@ def scan(input_bucket, input_key, download_path, definitions_path, tmp_path):
         else:
             raise ClamAVException(
                 f"ClamAV exited with unexpected code: {scan_summary.returncode}."
-                f"\nOutput: {scan_summary.stdout.decode('utf-8')}"
+                f"\nOutput: {scan_summary.stdout.decode('utf-8', 'replace')}"
             )
         set_status(input_bucket, input_key, status)
         return {
@@ -263,26 +610,127 @@ def scan(input_bucket, input_key, download_path, definitions_path, tmp_path):
             "input_bucket": input_bucket,
             "input_key": input_key,
             "status": status,
-            "message": scan_summary.stdout.decode("utf-8"),
+            "message": scan_summary.stdout.decode("utf-8", "replace"),
         }
     except subprocess.CalledProcessError as e:
         report_failure(input_bucket, input_key, download_path, str(e.stderr))
     except ClamAVException as e:
         report_failure(input_bucket, input_key, download_path, e.message)
+    except botocore.exceptions.ClientError as e:
+        report_failure(
+            input_bucket,
+            input_key,
+            download_path,
+            e.response["Error"]["Message"],
+        )
+    except (botocore.exceptions.BotoCoreError, OSError) as e:
+        report_failure(input_bucket, input_key, download_path, str(e))
+    finally:
+        if body is not None:
+            body.close()
+
+
+def clamd_instream(body, timeout):
+    """Streams the response body to clamd with the INSTREAM command. The
+    result uses the exit codes of clamdscan, without starting it"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        # A clamd that stops responding fails the scan before Lambda does
+        deadline = time.monotonic() + timeout
+        sock.settimeout(timeout)
+        sock.connect(CLAMD_SOCKET)
+        sock.sendall(b"zINSTREAM\0")
+        # clamd closes the stream early if it exceeds its limits
+        with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+            for chunk in iter(lambda: body.read(MB), b""):
+                sock.sendall(struct.pack("!L", len(chunk)) + chunk)
+            sock.sendall(struct.pack("!L", 0))
+        reply = b""
+        while not reply.endswith(b"\0"):
+            sock.settimeout(max(0.001, deadline - time.monotonic()))
+            data = sock.recv(4096)
+            if not data:
+                break
+            reply += data
+    reply = reply.rstrip(b"\0")
+    returncode = 2
+    if reply.endswith(b" OK"):
+        returncode = 0
+    elif reply.endswith(b" FOUND"):
+        returncode = 1
+    return subprocess.CompletedProcess("INSTREAM", returncode, stdout=reply)
 
 
 def delete(download_path, input_key=None):
-    """Deletes the file/folder from the EFS File System"""
+    """Deletes the file/folder from the payload directory"""
     if input_key:
         file = f"{download_path}/{input_key}"
         if os.path.exists(file):
             os.remove(file)
-    else:
-        for obj in glob.glob(os.path.join(download_path, "*")):
-            if os.path.isdir(obj):
-                shutil.rmtree(obj)
+    elif os.path.isdir(download_path):
+        delete_tree(download_path)
+        os.rmdir(download_path)
+        created_dirs.difference_update(
+            [
+                path
+                for path in created_dirs
+                if f"{path}/".startswith(f"{download_path}/")
+            ]
+        )
+
+
+def delete_stale_payloads():
+    """Deletes payload folders left in ephemeral storage by invocations that
+    did not finish, e.g. ones that timed out, since /tmp outlives them"""
+    with os.scandir(LOCAL_PAYLOAD_ROOT) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and is_uuid(entry.name):
+                delete(entry.path)
+
+
+def is_uuid(name):
+    """Checks if the name is a UUID, like the request ids naming payloads"""
+    try:
+        uuid.UUID(name)
+        return True
+    except ValueError:
+        return False
+
+
+def delete_tree(path):
+    """Deletes the contents of a directory, relying on the scandir entry
+    types instead of a stat per file"""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                delete_tree(entry.path)
+                os.rmdir(entry.path)
             else:
-                os.remove(obj)
+                os.unlink(entry.path)
+
+
+def run_command(command, stdin=None):
+    """Runs the command with its combined output going to a temporary file,
+    so verbose runs are not buffered in memory, and returns only the tail
+    of the output. Copies the optional stdin file object to the command's
+    standard input"""
+    with tempfile.TemporaryFile() as output:
+        with subprocess.Popen(
+            command,
+            stdin=None if stdin is None else subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            stdout=output,
+        ) as process:
+            if stdin is not None:
+                # If the command exits early its output and code say why
+                with contextlib.suppress(BrokenPipeError):
+                    shutil.copyfileobj(stdin, process.stdin, 8 * MB)
+                with contextlib.suppress(BrokenPipeError):
+                    process.stdin.close()
+        output.seek(max(0, output.seek(0, os.SEEK_END) - OUTPUT_MAX_BYTES))
+        tail = output.read()
+    return subprocess.CompletedProcess(
+        command, process.returncode, stdout=tail
+    )
 
 
 def report_failure(input_bucket, input_key, download_path, message):
@@ -297,3 +745,8 @@ def report_failure(input_bucket, input_key, download_path, message):
         "message": message,
     }
     raise Exception(json.dumps(exception_json))
+
+
+# Only update during init when running in Lambda, not on a plain import
+if "AWS_LAMBDA_RUNTIME_API" in os.environ:
+    freshclam_prewarm = prewarm_freshclam()
@@ -21,7 +21,7 @@ import {
   PolicyStatement,
 } from 'aws-cdk-lib/aws-iam';
 import {
-  Code, DockerImageCode,
+  CfnFunction, Code, DockerImageCode,
   DockerImageFunction, FileSystem as LambdaFileSystem, Function,
   IDestination, Runtime,
 } from 'aws-cdk-lib/aws-lambda';
@@ -413,6 +413,11 @@ export class ServerlessClamscan extends Construct {
         POWERTOOLS_SERVICE_NAME: 'virus-scan',
       },
     });
+    // clamd writes decompressed archive members and streamed objects to /tmp
+    (this._scanFunction.node.defaultChild as CfnFunction).addPropertyOverride(
+      'EphemeralStorage.Size',
+      10240,
+    );
     this._scanFunction.connections.allowToAnyIpv4(
       Port.tcp(443),
       'Allow outbound HTTPS traffic for S3 access.',
@@ -466,7 +471,8 @@ export class ServerlessClamscan extends Construct {
         path.join(__dirname, '../assets/lambda/code/initialize_defs_cr'),
       ),
       handler: 'lambda.lambda_handler',
-      timeout: Duration.minutes(5),
+      // Outlasts the synchronous invoke of the five minute download
+      timeout: Duration.minutes(6),
     });
     download_defs.grantInvoke(init_defs_cr);
     new CustomResource(this, 'InitDefsCr', {